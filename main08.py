@@ -1,17 +1,49 @@
-from fastapi import FastAPI, Request, Form, Response, HTTPException, Query
+from fastapi import FastAPI, Request, Form, Response, HTTPException, Query, Depends
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import RedirectResponse
-from sqlmodel import SQLModel, create_engine, Session, select, Field
+from fastapi.responses import (
+    RedirectResponse,
+    JSONResponse,
+    HTMLResponse,
+    PlainTextResponse,
+)
+from sqlmodel import SQLModel, create_engine, Session, select, update, delete, Field
 from starlette.middleware.sessions import SessionMiddleware
 from passlib.context import CryptContext
-from typing import Optional
-from datetime import datetime
+from sqlalchemy import Index, func, insert, inspect, literal_column
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from typing import Literal, Optional
+from datetime import date, datetime, timedelta
+import argparse
+import asyncio
+import fcntl
+import getpass
+import logging
+import math
+import mmap
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import Future
 
 app = FastAPI()
 
+logger = logging.getLogger("uvicorn.error")
+
 engine = create_engine("sqlite:///db.sqlite3", echo=True)
 
+TODO_SHARDS = int(os.environ.get("TODO_SHARDS", "0"))
+TODO_SHARD_DIR = os.environ.get("TODO_SHARD_DIR", "shards")
+
+CACHE_VERSION_FILE = os.environ.get("CACHE_VERSION_FILE", "cache_versions.bin")
+MAINTENANCE_LOCK_FILE = os.environ.get("MAINTENANCE_LOCK_FILE", "maintenance.lock")
+EVENT_LOG_FILE = os.environ.get("EVENT_LOG_FILE", "events.sqlite3")
+
 templates = Jinja2Templates(directory="templates")
+templates.env.globals["edit_prefetch"] = os.environ.get("EDIT_PREFETCH") == "1"
 
 app.add_middleware(
     SessionMiddleware,
@@ -23,6 +55,84 @@ app.add_middleware(
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+registered_emails = set()
+
+ADMIN_EMAIL = "admin@example.com"
+# bcrypt hash of the default admin password "pass"
+ADMIN_PASSWORD_HASH = "$2b$12$KM/Pn5IXS7dKfI8DdCwH9OVWbpaUj6Zr2UJu8CikrwXjb9hf1IPHu"
+
+STARTUP_BUDGET = float(os.environ.get("STARTUP_BUDGET", "0.5"))
+
+AUTH_PATHS = ("/login", "/logout", "/register")
+
+
+class AdmissionController:
+    def __init__(self, limit, queue_size, timeout):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.waiting = 0
+
+    @property
+    def retry_after(self):
+        return str(max(1, math.ceil(self.timeout)))
+
+    async def acquire(self):
+        if self.semaphore.locked() and self.waiting >= self.queue_size:
+            return False
+
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting -= 1
+        return True
+
+    def release(self):
+        self.semaphore.release()
+
+
+def admission_controller(route_class, limit, queue_size):
+    prefix = f"ADMISSION_{route_class.upper()}"
+    return AdmissionController(
+        limit=int(os.environ.get(f"{prefix}_LIMIT", limit)),
+        queue_size=int(os.environ.get(f"{prefix}_QUEUE", queue_size)),
+        timeout=float(os.environ.get("ADMISSION_TIMEOUT", "2")),
+    )
+
+
+# keep the sum of the limits below AnyIO's default of 40 worker threads
+admission = {
+    "auth": admission_controller("auth", limit=4, queue_size=16),
+    "read": admission_controller("read", limit=16, queue_size=64),
+    "write": admission_controller("write", limit=8, queue_size=32),
+}
+
+
+def route_class(request: Request):
+    if request.method in ("GET", "HEAD"):
+        return "read"
+    if request.url.path in AUTH_PATHS:
+        return "auth"
+    return "write"
+
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    controller = admission[route_class(request)]
+    if not await controller.acquire():
+        return Response(
+            status_code=503, headers={"Retry-After": controller.retry_after}
+        )
+
+    maintenance.touch()
+    try:
+        return await call_next(request)
+    finally:
+        controller.release()
+
 
 def hash_password(pw):
     return pwd_context.hash(pw)
@@ -42,21 +152,340 @@ class User(SQLModel, table=True):
     email: str = Field(index=True, unique=True)
     password_hash: str
     user_name: str = Field(index=True)
+    is_admin: bool = Field(default=False, sa_column_kwargs={"server_default": "0"})
 
 
 class Todo(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_todo_user_id_create_date", "user_id", "create_date"),
+        Index("ix_todo_user_id_task", "user_id", "task"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     create_date: datetime = Field(default_factory=datetime.now)
     task: str
     user_id: int = Field(foreign_key="user.id", index=True)
 
 
+class UserStats(SQLModel, table=True):
+    user_id: int = Field(foreign_key="user.id", primary_key=True)
+    total: int = 0
+
+
+class DailyTaskStats(SQLModel, table=True):
+    user_id: int = Field(foreign_key="user.id", primary_key=True)
+    day: date = Field(primary_key=True)
+    created: int = 0
+
+
+def record_task_created(session, user_id, day):
+    session.exec(
+        sqlite_insert(UserStats)
+        .values(user_id=user_id, total=1)
+        .on_conflict_do_update(
+            index_elements=["user_id"], set_={"total": UserStats.total + 1}
+        )
+    )
+    session.exec(
+        sqlite_insert(DailyTaskStats)
+        .values(user_id=user_id, day=day, created=1)
+        .on_conflict_do_update(
+            index_elements=["user_id", "day"],
+            set_={"created": DailyTaskStats.created + 1},
+        )
+    )
+
+
+def record_task_deleted(session, user_id):
+    session.exec(
+        update(UserStats)
+        .where(UserStats.user_id == user_id)
+        .values(total=UserStats.total - 1)
+    )
+
+
+def get_task_stats(session, user_id):
+    user_stats = session.get(UserStats, user_id)
+    daily_stats = session.get(DailyTaskStats, (user_id, date.today()))
+    return {
+        "total": user_stats.total if user_stats else 0,
+        "today": daily_stats.created if daily_stats else 0,
+    }
+
+
+SHARD_TABLES = [Todo.__table__, UserStats.__table__, DailyTaskStats.__table__]
+
+
+def shard_engines_for(shards):
+    if not shards:
+        return []
+    os.makedirs(TODO_SHARD_DIR, exist_ok=True)
+    return [
+        create_engine(f"sqlite:///{TODO_SHARD_DIR}/todo_{i}.sqlite3", echo=True)
+        for i in range(shards)
+    ]
+
+
+def shard_index(user_id, shards):
+    return zlib.crc32(str(user_id).encode()) % shards
+
+
+shard_engines = shard_engines_for(TODO_SHARDS)
+
+
+def todo_engine(user_id, engines=None):
+    # users always live in db.sqlite3; their todos and stats may live in a shard
+    engines = shard_engines if engines is None else engines
+    if not engines:
+        return engine
+    return engines[shard_index(user_id, len(engines))]
+
+
+TaskSort = Literal["newest", "oldest", "alphabetical"]
+
+# each ordering is read straight off an (user_id, ...) index so SQLite never sorts
+TASK_SORTS = {
+    "newest": (Todo.create_date.desc(), Todo.id.desc()),
+    "oldest": (Todo.create_date, Todo.id),
+    "alphabetical": (Todo.task, Todo.id),
+}
+
+
+def parse_date(value):
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=422)
+
+
+def without_index(column):
+    # SQLite's unary "+" stops a term from being used for an index lookup
+    return literal_column(f"+{column.table.name}.{column.name}", column.type)
+
+
+def task_list_statement(user_id, q="", sort="oldest", date_from=None, date_to=None):
+    stmt = select(Todo).where(Todo.user_id == user_id)
+
+    # a create_date range would otherwise pull the alphabetical order off its index
+    create_date = (
+        without_index(Todo.create_date) if sort == "alphabetical" else Todo.create_date
+    )
+    if q:
+        stmt = stmt.where(Todo.task.contains(q))
+    if date_from:
+        stmt = stmt.where(
+            create_date >= datetime.combine(date_from, datetime.min.time())
+        )
+    # nothing comes after date.max, and adding a day to it would overflow
+    if date_to and date_to < date.max:
+        stmt = stmt.where(
+            create_date
+            < datetime.combine(date_to + timedelta(days=1), datetime.min.time())
+        )
+    return stmt.order_by(*TASK_SORTS[sort])
+
+
+class SearchCoalescer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latest = {}
+        self.in_flight = {}
+
+    def begin(self, user_id):
+        with self.lock:
+            sequence = self.latest.get(user_id, 0) + 1
+            self.latest[user_id] = sequence
+        return sequence
+
+    def is_stale(self, user_id, sequence):
+        return self.latest.get(user_id) != sequence
+
+    def run(self, key, fn):
+        with self.lock:
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self.in_flight[key] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+
+search_coalescer = SearchCoalescer()
+
+
+class VersionCounters:
+    # per-user counters in a memory-mapped file, shared by every worker process;
+    # one extra slot after them holds the time of the latest request
+    def __init__(self, path, slots=4096):
+        self.slots = slots
+        size = (slots + 1) * 8
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        self.counters = memoryview(self.map).cast("Q")
+        self.lock = threading.Lock()
+
+    def slot(self, user_id):
+        return zlib.crc32(str(user_id).encode()) % self.slots
+
+    def get(self, user_id):
+        return self.counters[self.slot(user_id)]
+
+    def touch(self):
+        self.counters[self.slots] = time.monotonic_ns()
+
+    def last_activity(self):
+        return self.counters[self.slots] / 1e9
+
+    def bump(self, user_id):
+        # lockf only excludes other processes, the thread lock covers this one
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                self.counters[self.slot(user_id)] += 1
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+
+class UserCache:
+    # LRU whose entries are dropped once their user's version moves on
+    def __init__(self, versions, max_entries):
+        self.versions = versions
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id, key):
+        version = self.versions.get(user_id)
+        with self.lock:
+            entry = self.entries.get((user_id, key))
+            if entry is None or entry[0] != version:
+                return version, None
+            self.entries.move_to_end((user_id, key))
+            return version, entry[1]
+
+    def put(self, user_id, key, version, value):
+        with self.lock:
+            self.entries[(user_id, key)] = (version, value)
+            self.entries.move_to_end((user_id, key))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+cache_versions = VersionCounters(CACHE_VERSION_FILE)
+task_list_cache = UserCache(
+    cache_versions, max_entries=int(os.environ.get("TASK_LIST_CACHE_SIZE", "4096"))
+)
+edit_fragment_cache = UserCache(
+    cache_versions, max_entries=int(os.environ.get("EDIT_FRAGMENT_CACHE_SIZE", "4096"))
+)
+
+
+def cached_task_list(user_id, q="", sort="oldest", date_from="", date_to=""):
+    key = (q, sort, date_from, date_to)
+    version, task_list = task_list_cache.get(user_id, key)
+    if task_list is None:
+        stmt = task_list_statement(
+            user_id, q, sort, parse_date(date_from), parse_date(date_to)
+        )
+        with Session(todo_engine(user_id)) as session:
+            task_list = session.exec(stmt).all()
+        task_list_cache.put(user_id, key, version, task_list)
+    return task_list
+
+
+class TokenBucketLimiter:
+    def __init__(self, rate, burst, sweep_interval=60):
+        self.rate = rate
+        self.burst = burst
+        self.sweep_interval = sweep_interval
+        self.lock = threading.Lock()
+        # key -> (tokens, last refill time)
+        self.buckets = {}
+        self.next_sweep = time.monotonic() + sweep_interval
+
+    def acquire(self, key):
+        now = time.monotonic()
+        with self.lock:
+            if now >= self.next_sweep:
+                self.evict_idle(now)
+
+            tokens, updated = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return (1 - tokens) / self.rate
+
+            self.buckets[key] = (tokens - 1, now)
+            return 0
+
+    def evict_idle(self, now):
+        # a bucket idle long enough to refill completely is the same as no bucket
+        full_after = self.burst / self.rate
+        self.buckets = {
+            key: bucket
+            for key, bucket in self.buckets.items()
+            if now - bucket[1] < full_after
+        }
+        self.next_sweep = now + self.sweep_interval
+
+
+def rate_limiter(name, rate, burst):
+    prefix = f"RATE_LIMIT_{name.upper()}"
+    return TokenBucketLimiter(
+        rate=float(os.environ.get(f"{prefix}_RATE", rate)),
+        burst=float(os.environ.get(f"{prefix}_BURST", burst)),
+    )
+
+
+user_write_limiter = rate_limiter("user_write", rate=5, burst=20)
+ip_write_limiter = rate_limiter("ip_write", rate=20, burst=60)
+ip_login_limiter = rate_limiter("ip_login", rate=0.5, burst=10)
+
+
+def client_ip(request: Request):
+    return request.client.host if request.client else ""
+
+
+def check_rate_limit(limiter, key):
+    retry_after = limiter.acquire(key)
+    if retry_after:
+        raise HTTPException(
+            status_code=429, headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+
+
+def limit_writes(request: Request):
+    check_rate_limit(user_write_limiter, get_user_id(request))
+    check_rate_limit(ip_write_limiter, client_ip(request))
+
+
+def limit_logins(request: Request):
+    check_rate_limit(ip_login_limiter, client_ip(request))
+
+
 @app.get("/login")
 def login_page(request: Request):
     return templates.TemplateResponse("login.html", {"request": request})
 
 
-@app.post("/login")
+@app.post("/login", dependencies=[Depends(limit_logins)])
 def login(request: Request, email: str = Form(...), password: str = Form(...)):
     with Session(engine) as session:
         user = session.exec(select(User).where(User.email == email)).first()
@@ -81,89 +510,163 @@ def logout(request: Request):
 
 
 @app.get("/")
-def index(request: Request):
+def index(
+    request: Request,
+    q: str = Query(default=""),
+    sort: TaskSort = Query(default="oldest"),
+    date_from: str = Query(default=""),
+    date_to: str = Query(default=""),
+):
     user_id = get_user_id(request)
     if not user_id:
         return RedirectResponse(url="/login", status_code=303)
 
+    task_list = cached_task_list(user_id, q.strip(), sort, date_from, date_to)
     with Session(engine) as session:
         user = session.exec(select(User).where(User.id == user_id)).first()
-        task_list = session.exec(select(Todo).where(Todo.user_id == user_id)).all()
+
+    with Session(todo_engine(user_id)) as session:
+        stats = get_task_stats(session, user_id)
 
     return templates.TemplateResponse(
-        "index.html", {"request": request, "task_list": task_list, "user": user}
+        "index.html",
+        {
+            "request": request,
+            "task_list": task_list,
+            "user": user,
+            "stats": stats,
+            "q": q,
+            "sort": sort,
+            "date_from": date_from,
+            "date_to": date_to,
+        },
     )
 
 
-@app.post("/task/submit")
-def add_task(request: Request, task: str = Form(...)):
+@app.post("/task/submit", dependencies=[Depends(limit_writes)])
+def add_task(
+    request: Request,
+    task: str = Form(...),
+    q: str = Form(default=""),
+    sort: TaskSort = Form(default="oldest"),
+    date_from: str = Form(default=""),
+    date_to: str = Form(default=""),
+):
     user_id = get_user_id(request)
+    list_stmt = task_list_statement(
+        user_id, q.strip(), sort, parse_date(date_from), parse_date(date_to)
+    )
     todo = Todo(task=task, user_id=user_id)
 
-    with Session(engine) as session:
+    with Session(todo_engine(user_id)) as session:
         session.add(todo)
+        record_task_created(session, user_id, todo.create_date.date())
+        # the stats upsert already flushed the insert; read the id before
+        # commit expires it
+        todo_id = todo.id
         session.commit()
+        cache_versions.bump(user_id)
+        event_log.record(user_id, "create", todo_id)
 
-        task_list = session.exec(select(Todo).where(Todo.user_id == user_id)).all()
+        task_list = session.exec(list_stmt).all()
+        stats = get_task_stats(session, user_id)
 
     return templates.TemplateResponse(
-        "task_list_fragment.html", {"request": request, "task_list": task_list}
+        "task_list_fragment.html",
+        {"request": request, "task_list": task_list, "stats": stats, "oob": True},
     )
 
 
-@app.delete("/task/{task_id}")
-def delete_task(request: Request, task_id: int):
+@app.delete("/task/{task_id}", dependencies=[Depends(limit_writes)])
+def delete_task(
+    request: Request,
+    task_id: int,
+    q: str = Query(default=""),
+    sort: TaskSort = Query(default="oldest"),
+    date_from: str = Query(default=""),
+    date_to: str = Query(default=""),
+):
     user_id = get_user_id(request)
-    with Session(engine) as session:
-        task = session.exec(
-            select(Todo).where(Todo.user_id == user_id, Todo.id == task_id)
+    list_stmt = task_list_statement(
+        user_id, q.strip(), sort, parse_date(date_from), parse_date(date_to)
+    )
+    with Session(todo_engine(user_id)) as session:
+        deleted = session.exec(
+            delete(Todo)
+            .where(Todo.user_id == user_id, Todo.id == task_id)
+            .returning(Todo.id)
         ).first()
-        if not task:
+        if not deleted:
             raise HTTPException(status_code=404)
 
-        session.delete(task)
+        record_task_deleted(session, user_id)
         session.commit()
+        cache_versions.bump(user_id)
+        event_log.record(user_id, "delete", task_id)
 
-        task_list = session.exec(select(Todo).where(Todo.user_id == user_id)).all()
+        task_list = session.exec(list_stmt).all()
+        stats = get_task_stats(session, user_id)
 
     return templates.TemplateResponse(
-        "task_list_fragment.html", {"request": request, "task_list": task_list}
+        "task_list_fragment.html",
+        {"request": request, "task_list": task_list, "stats": stats, "oob": True},
     )
 
 
 @app.get("/task/{task_id}/edit")
-def edit_task(request: Request, task_id: int):
+def edit_task(request: Request, task_id: int, prefetch: bool = Query(default=False)):
     user_id = get_user_id(request)
-    with Session(engine) as session:
-        task = session.exec(
-            select(Todo).where(Todo.id == task_id, Todo.user_id == user_id)
-        ).first()
-
-        if not task:
-            raise HTTPException(status_code=404)
+    version, html = edit_fragment_cache.get(user_id, task_id)
+    if html is None:
+        with Session(todo_engine(user_id)) as session:
+            task = session.exec(
+                select(Todo).where(Todo.id == task_id, Todo.user_id == user_id)
+            ).first()
+
+            if not task:
+                raise HTTPException(status_code=404)
+
+        html = templates.get_template("task_edit_fragment.html").render(
+            request=request, task_id=task_id, todo=task
+        )
+        edit_fragment_cache.put(user_id, task_id, version, html)
 
-    return templates.TemplateResponse(
-        "task_edit_fragment.html",
-        {"request": request, "task_id": task_id, "todo": task},
-    )
+    # a hover prefetch only warms the cache
+    if prefetch:
+        return Response(status_code=204)
+    return HTMLResponse(html)
 
 
-@app.patch("/task/{task_id}/update")
-def update_task(request: Request, task_id: int, task: str = Form(...)):
+@app.patch("/task/{task_id}/update", dependencies=[Depends(limit_writes)])
+def update_task(
+    request: Request,
+    task_id: int,
+    task: str = Form(...),
+    q: str = Form(default=""),
+    sort: TaskSort = Form(default="oldest"),
+    date_from: str = Form(default=""),
+    date_to: str = Form(default=""),
+):
     user_id = get_user_id(request)
-    with Session(engine) as session:
-        todo = session.exec(
-            select(Todo).where(Todo.id == task_id, Todo.user_id == user_id)
+    list_stmt = task_list_statement(
+        user_id, q.strip(), sort, parse_date(date_from), parse_date(date_to)
+    )
+    with Session(todo_engine(user_id)) as session:
+        updated = session.exec(
+            update(Todo)
+            .where(Todo.id == task_id, Todo.user_id == user_id)
+            .values(task=task)
+            .returning(Todo.id)
         ).first()
 
-        if not todo:
+        if not updated:
             raise HTTPException(status_code=404)
 
-        todo.task = task
-        session.add(todo)
         session.commit()
+        cache_versions.bump(user_id)
+        event_log.record(user_id, "update", task_id)
 
-        task_list = session.exec(select(Todo).where(Todo.user_id == user_id)).all()
+        task_list = session.exec(list_stmt).all()
 
     return templates.TemplateResponse(
         "task_list_fragment.html", {"request": request, "task_list": task_list}
@@ -188,56 +691,673 @@ def register(
             "register.html",
             {"request": request, "error": "パスワードは６文字以上にしてください"},
         )
-    with Session(engine) as session:
-
-        exists = session.exec(select(User).where(User.email == email)).first()
+    if email in registered_emails:
+        return templates.TemplateResponse(
+            "register.html", {"request": request, "error": "すでに登録されています"}
+        )
 
-        if exists:
+    user = User(email=email, password_hash=hash_password(password), user_name=user_name)
+    with Session(engine) as session:
+        session.add(user)
+        try:
+            session.commit()
+        except IntegrityError:
+            registered_emails.add(email)
             return templates.TemplateResponse(
                 "register.html", {"request": request, "error": "すでに登録されています"}
             )
-        user = User(
-            email=email, password_hash=hash_password(password), user_name=user_name
-        )
-        session.add(user)
-        session.commit()
 
+    registered_emails.add(email)
     return RedirectResponse(url="/", status_code=303)
 
 
 @app.get("/task/search")
-def search_task(request: Request, q: str = Query(default="")):
+def search_task(
+    request: Request,
+    q: str = Query(default=""),
+    sort: TaskSort = Query(default="oldest"),
+    date_from: str = Query(default=""),
+    date_to: str = Query(default=""),
+):
     user_id = get_user_id(request)
     q = q.strip()
+    sequence = search_coalescer.begin(user_id)
 
-    with Session(engine) as session:
-        stmt = select(Todo).where(Todo.user_id == user_id)
+    task_list = search_coalescer.run(
+        (user_id, q, sort, date_from, date_to),
+        lambda: cached_task_list(user_id, q, sort, date_from, date_to),
+    )
 
-        if q:
-            stmt = stmt.where(Todo.task.contains(q))
-        task_list = session.exec(stmt).all()
+    # a newer search from the same user has superseded this one
+    if search_coalescer.is_stale(user_id, sequence):
+        return Response(status_code=204)
 
-        return templates.TemplateResponse(
-            "task_list_fragment.html", {"request": request, "task_list": task_list}
+    return templates.TemplateResponse(
+        "task_list_fragment.html", {"request": request, "task_list": task_list}
+    )
+
+
+def create_tables(conn, tables):
+    SQLModel.metadata.create_all(conn, tables=tables)
+
+
+def seed_admin(conn, tables):
+    if tables is not None and User.__table__ not in tables:
+        return
+    # spelled out so it only names the columns that existed at this version
+    conn.exec_driver_sql(
+        "INSERT OR IGNORE INTO user (email, password_hash, user_name)"
+        " VALUES (?, ?, ?)",
+        (ADMIN_EMAIL, ADMIN_PASSWORD_HASH, "admin"),
+    )
+
+
+def create_task_sort_indexes(conn, tables):
+    for index in Todo.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
+def create_task_stats(conn, tables):
+    SQLModel.metadata.create_all(
+        conn, tables=[UserStats.__table__, DailyTaskStats.__table__]
+    )
+    conn.execute(
+        insert(UserStats).from_select(
+            ["user_id", "total"],
+            select(Todo.user_id, func.count()).group_by(Todo.user_id),
+        )
+    )
+    day = func.date(Todo.create_date)
+    conn.execute(
+        insert(DailyTaskStats).from_select(
+            ["user_id", "day", "created"],
+            select(Todo.user_id, day, func.count()).group_by(Todo.user_id, day),
         )
+    )
+
 
+def enable_incremental_vacuum(conn, tables):
+    # auto_vacuum only takes effect after a full VACUUM, and neither VACUUM
+    # nor a journal_mode change may run inside a transaction
+    conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.exec_driver_sql("VACUUM")
+    conn.exec_driver_sql("PRAGMA journal_mode = WAL")
 
-def create_admin_if_needed():
+
+def add_admin_flag(conn, tables):
+    if tables is not None and User.__table__ not in tables:
+        return
+    # databases created after this column was added already have it
+    columns = {column["name"] for column in inspect(conn).get_columns("user")}
+    if "is_admin" not in columns:
+        conn.exec_driver_sql(
+            "ALTER TABLE user ADD COLUMN is_admin BOOLEAN NOT NULL DEFAULT 0"
+        )
+    conn.execute(update(User).where(User.email == ADMIN_EMAIL).values(is_admin=True))
+
+
+MIGRATIONS = [
+    create_tables,
+    seed_admin,
+    create_task_sort_indexes,
+    create_task_stats,
+    enable_incremental_vacuum,
+    add_admin_flag,
+]
+
+
+def migrate(db_engine, tables=None):
+    # workers started side by side must not migrate at the same time; the
+    # version is read under the lock, so a worker that waited skips the
+    # migrations another one has already applied
+    with open(f"{db_engine.url.database}.migrate.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        with db_engine.connect() as conn:
+            version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                migration(conn, tables)
+                conn.exec_driver_sql(f"PRAGMA user_version = {number}")
+                conn.commit()
+
+
+def migrate_all():
+    migrate(engine)
+    for shard_engine in shard_engines:
+        migrate(shard_engine, SHARD_TABLES)
+
+
+def move_user_todos(user_id, source, target):
+    with Session(source) as session:
+        todos = session.exec(
+            select(Todo).where(Todo.user_id == user_id).order_by(Todo.id)
+        ).all()
+        user_stats = session.get(UserStats, user_id)
+        daily_stats = session.exec(
+            select(DailyTaskStats).where(DailyTaskStats.user_id == user_id)
+        ).all()
+
+    # todo ids are only unique per database, so moved rows get new ids; clearing
+    # the target first makes a rerun after an interrupted move safe
+    with Session(target) as session:
+        for model in (Todo, UserStats, DailyTaskStats):
+            session.exec(delete(model).where(model.user_id == user_id))
+        session.add_all(
+            Todo(task=t.task, create_date=t.create_date, user_id=user_id) for t in todos
+        )
+        if user_stats:
+            session.add(UserStats(user_id=user_id, total=user_stats.total))
+        session.add_all(
+            DailyTaskStats(user_id=user_id, day=d.day, created=d.created)
+            for d in daily_stats
+        )
+        session.commit()
+
+    with Session(source) as session:
+        for model in (Todo, UserStats, DailyTaskStats):
+            session.exec(delete(model).where(model.user_id == user_id))
+        session.commit()
+    return len(todos)
+
+
+def rebalance(old_shards, new_shards):
+    sources = shard_engines_for(old_shards) or [engine]
+    targets = shard_engines_for(new_shards)
+    for target in targets:
+        migrate(target, SHARD_TABLES)
+
+    moved = 0
+    for source in sources:
+        with Session(source) as session:
+            user_ids = set(session.exec(select(Todo.user_id).distinct()).all())
+            user_ids.update(session.exec(select(UserStats.user_id)).all())
+
+        for user_id in sorted(user_ids):
+            target = todo_engine(user_id, targets)
+            if target.url != source.url:
+                moved += move_user_todos(user_id, source, target)
+    return moved
+
+
+def explain_task_queries(db_engine):
+    plans = {}
+    with db_engine.connect() as conn:
+        for sort in TASK_SORTS:
+            for q in ("", "keyword"):
+                for date_range in ((None, None), (date.today(), date.today())):
+                    stmt = task_list_statement(1, q, sort, *date_range)
+                    compiled = stmt.compile(dialect=db_engine.dialect)
+                    # the plan does not depend on the bound values
+                    params = (None,) * len(compiled.positiontup)
+                    plan = conn.exec_driver_sql(
+                        f"EXPLAIN QUERY PLAN {compiled}", params
+                    ).all()
+                    plans[(sort, q, *date_range)] = [row[-1] for row in plan]
+    return plans
+
+
+def create_admin(email, password, user_name):
+    email = email.strip().lower()
     with Session(engine) as session:
-        exists = session.exec(
-            select(User).where(User.email == "admin@example.com")
-        ).first()
-        if not exists:
-            u = User(
-                email="admin@example.com",
-                password_hash=hash_password("pass"),
-                user_name="admin",
-            )
-            session.add(u)
+        user = User(
+            email=email,
+            password_hash=hash_password(password),
+            user_name=user_name,
+            is_admin=True,
+        )
+        session.add(user)
+        try:
             session.commit()
+        except IntegrityError:
+            raise SystemExit(f"{email} is already registered")
+
+
+def load_registered_emails():
+    with Session(engine) as session:
+        registered_emails.update(session.exec(select(User.email)).all())
+
+
+class MaintenanceScheduler:
+    def __init__(self, db_engines, activity, interval, quiet_period, vacuum_pages):
+        self.db_engines = db_engines
+        self.interval = interval
+        self.quiet_period = quiet_period
+        # (name, statement, seconds between runs)
+        self.tasks = [
+            ("wal_checkpoint", "PRAGMA wal_checkpoint(PASSIVE)", 60),
+            ("optimize", "PRAGMA optimize", 3600),
+            ("analyze", "ANALYZE", 86400),
+            ("incremental_vacuum", f"PRAGMA incremental_vacuum({vacuum_pages})", 0),
+        ]
+        self.next_run = {name: 0 for name, _, _ in self.tasks}
+        self.timings = {}
+        # shared with the other workers, so quiet means quiet across all of them
+        self.activity = activity
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def touch(self):
+        self.activity.touch()
+
+    def is_quiet(self):
+        return time.monotonic() - self.activity.last_activity() >= self.quiet_period
+
+    def start(self):
+        if self.interval <= 0 or self.thread:
+            return
+        # with several workers only the one holding the lock does maintenance
+        self.lock_fd = os.open(MAINTENANCE_LOCK_FILE, os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self.lock_fd)
+            return
+        self.touch()
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self.loop, name="sqlite-maintenance", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+            os.close(self.lock_fd)
+
+    def loop(self):
+        while not self.stop_event.wait(self.interval):
+            if self.is_quiet():
+                try:
+                    self.run_next()
+                except Exception:
+                    logger.exception("sqlite maintenance failed")
+
+    def run_next(self):
+        # one small step per wake-up so a burst of traffic never waits long
+        now = time.monotonic()
+        for name, statement, period in self.tasks:
+            if now < self.next_run[name]:
+                continue
+            db_engines = self.db_engines
+            if name == "incremental_vacuum":
+                db_engines = [e for e in db_engines if self.free_pages(e)]
+                if not db_engines:
+                    continue
+            self.run(name, statement, db_engines)
+            self.next_run[name] = now + period
+            return
+
+    def free_pages(self, db_engine):
+        with db_engine.connect() as conn:
+            return freelist_count(conn)
+
+    def run(self, name, statement, db_engines):
+        started = time.perf_counter()
+        freed = 0
+        for db_engine in db_engines:
+            with db_engine.connect() as conn:
+                if name == "incremental_vacuum":
+                    before = freelist_count(conn)
+                    # sqlite3 stops a statement without result columns after its
+                    # first step, which frees a single page; executescript runs
+                    # the pragma to completion
+                    conn.connection.driver_connection.executescript(f"{statement};")
+                    freed += before - freelist_count(conn)
+                    continue
+                result = conn.exec_driver_sql(statement)
+                if result.returns_rows:
+                    result.fetchall()
+                conn.commit()
+        duration = time.perf_counter() - started
+
+        timing = self.timings.setdefault(name, {"runs": 0, "total_seconds": 0.0})
+        timing["runs"] += 1
+        timing["total_seconds"] += duration
+        timing["last_seconds"] = duration
+        timing["last_run"] = datetime.now().isoformat(timespec="seconds")
+        if name == "incremental_vacuum":
+            timing["last_pages_freed"] = freed
+            timing["total_pages_freed"] = timing.get("total_pages_freed", 0) + freed
+
+
+def freelist_count(conn):
+    return conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+
+
+maintenance = MaintenanceScheduler(
+    [engine, *shard_engines],
+    cache_versions,
+    interval=float(os.environ.get("MAINTENANCE_INTERVAL", "10")),
+    quiet_period=float(os.environ.get("MAINTENANCE_QUIET", "30")),
+    vacuum_pages=int(os.environ.get("MAINTENANCE_VACUUM_PAGES", "200")),
+)
+
+
+class EventLog:
+    # Events are queued in memory and written in batches by a background thread,
+    # so the request's own transaction never waits on the log. When the queue is
+    # full new events are dropped rather than blocking the request, and a batch
+    # that fails to write is dropped too; both are counted in "dropped".
+    def __init__(self, db_engine, max_events, batch_size, flush_interval):
+        self.db_engine = db_engine
+        self.max_events = max_events
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.events = deque()
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.written = 0
+        self.wakeup = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def record(self, user_id, action, todo_id):
+        with self.lock:
+            if len(self.events) >= self.max_events:
+                self.dropped += 1
+                return
+            self.events.append((time.time(), user_id, action, todo_id))
+            if len(self.events) >= self.batch_size:
+                self.wakeup.set()
+
+    def start(self):
+        with self.db_engine.connect() as conn:
+            conn.exec_driver_sql("PRAGMA journal_mode = WAL")
+            conn.exec_driver_sql(
+                "CREATE TABLE IF NOT EXISTS event "
+                "(ts REAL NOT NULL, user_id INTEGER, action TEXT NOT NULL,"
+                " todo_id INTEGER)"
+            )
+            conn.commit()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.loop, name="event-log", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def loop(self):
+        while not self.stop_event.is_set():
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        while True:
+            with self.lock:
+                batch = [
+                    self.events.popleft()
+                    for _ in range(min(self.batch_size, len(self.events)))
+                ]
+            if not batch:
+                return
+            try:
+                with self.db_engine.connect() as conn:
+                    conn.exec_driver_sql(
+                        "INSERT INTO event (ts, user_id, action, todo_id)"
+                        " VALUES (?, ?, ?, ?)",
+                        batch,
+                    )
+                    conn.commit()
+            except Exception:
+                logger.exception("writing %d events failed", len(batch))
+                with self.lock:
+                    self.dropped += len(batch)
+                return
+            self.written += len(batch)
+
+
+event_log = EventLog(
+    create_engine(f"sqlite:///{EVENT_LOG_FILE}"),
+    max_events=int(os.environ.get("EVENT_LOG_MAX_EVENTS", "10000")),
+    batch_size=int(os.environ.get("EVENT_LOG_BATCH_SIZE", "500")),
+    flush_interval=float(os.environ.get("EVENT_LOG_FLUSH_INTERVAL", "1")),
+)
+
+
+def require_admin(request: Request):
+    user_id = get_user_id(request)
+    with Session(engine) as session:
+        user = session.get(User, user_id) if user_id else None
+    if not user or not user.is_admin:
+        raise HTTPException(status_code=403)
+
+
+@app.get("/admin/maintenance")
+def maintenance_status(request: Request):
+    require_admin(request)
+    return JSONResponse(
+        {
+            "quiet": maintenance.is_quiet(),
+            "timings": maintenance.timings,
+        }
+    )
+
+
+@app.get("/admin/events")
+def event_log_status(request: Request):
+    require_admin(request)
+    return JSONResponse(
+        {
+            "queued": len(event_log.events),
+            "written": event_log.written,
+            "dropped": event_log.dropped,
+        }
+    )
+
+
+class RouteProfiler:
+    # A sampler thread walks the worker threads' stacks while profiled requests
+    # are in flight; samples are attributed to a request through the `request`
+    # argument of the endpoint frame on that stack.
+    def __init__(self, sample_rate, slow_seconds, interval):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.interval = interval
+        self.enabled = sample_rate > 0 or slow_seconds > 0
+        self.requests_seen = 0
+        self.endpoint_codes = set()
+        self.active = {}
+        self.profiles = defaultdict(Counter)
+        self.lock = threading.Lock()
+        self.has_work = threading.Event()
+        self.thread = None
+
+    def start(self, routes):
+        if not self.enabled or self.thread:
+            return
+        self.endpoint_codes = {
+            route.endpoint.__code__ for route in routes if hasattr(route, "endpoint")
+        }
+        self.thread = threading.Thread(
+            target=self.loop, name="route-profiler", daemon=True
+        )
+        self.thread.start()
+
+    def begin(self, scope):
+        self.requests_seen += 1
+        sampled = bool(self.sample_rate) and self.requests_seen % self.sample_rate == 0
+        # a request can only turn out slow after the fact, so with a latency
+        # threshold every request is sampled and fast ones are discarded
+        if not sampled and not self.slow_seconds:
+            return None, False
+        stacks = Counter()
+        with self.lock:
+            self.active[id(scope)] = stacks
+            self.has_work.set()
+        return stacks, sampled
+
+    def end(self, scope, route, stacks, keep):
+        with self.lock:
+            del self.active[id(scope)]
+            if not self.active:
+                self.has_work.clear()
+            if keep:
+                self.profiles[route].update(stacks)
+
+    def loop(self):
+        while True:
+            self.has_work.wait()
+            self.sample()
+            time.sleep(self.interval)
+
+    def sample(self):
+        for frame in sys._current_frames().values():
+            stack = []
+            while frame is not None:
+                stack.append(frame)
+                if frame.f_code in self.endpoint_codes:
+                    request = frame.f_locals.get("request")
+                    folded = ";".join(map(frame_label, reversed(stack)))
+                    # end() merges a request's Counter under the lock, so it must
+                    # not grow while being merged
+                    with self.lock:
+                        stacks = self.active.get(id(getattr(request, "scope", None)))
+                        if stacks is not None:
+                            stacks[folded] += 1
+                    break
+                frame = frame.f_back
+
+    def folded(self, route="", reset=False):
+        with self.lock:
+            lines = [
+                f"{name};{stack} {count}"
+                for name, stacks in self.profiles.items()
+                if not route or name == route
+                for stack, count in stacks.items()
+            ]
+            if reset:
+                self.profiles.clear()
+        return "".join(f"{line}\n" for line in lines)
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return (
+        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    )
+
+
+profiler = RouteProfiler(
+    sample_rate=int(os.environ.get("PROFILE_SAMPLE_RATE", "0")),
+    slow_seconds=float(os.environ.get("PROFILE_SLOW_MS", "0")) / 1000,
+    interval=float(os.environ.get("PROFILE_INTERVAL_MS", "5")) / 1000,
+)
+
+
+async def profile_requests(request: Request, call_next):
+    stacks, sampled = profiler.begin(request.scope)
+    if stacks is None:
+        return await call_next(request)
+
+    started = time.perf_counter()
+    try:
+        return await call_next(request)
+    finally:
+        elapsed = time.perf_counter() - started
+        slow = bool(profiler.slow_seconds) and elapsed >= profiler.slow_seconds
+        route = request.scope.get("route")
+        profiler.end(
+            request.scope,
+            getattr(route, "path", request.url.path),
+            stacks,
+            sampled or slow,
+        )
+
+
+# only installed when enabled, so a disabled profiler costs nothing per request
+if profiler.enabled:
+    app.middleware("http")(profile_requests)
+
+
+@app.get("/admin/profile")
+def profile_report(
+    request: Request,
+    route: str = Query(default=""),
+    reset: bool = Query(default=False),
+):
+    require_admin(request)
+    return PlainTextResponse(profiler.folded(route, reset))
 
 
 @app.on_event("startup")
 def on_startup():
-    SQLModel.metadata.create_all(engine)
-    create_admin_if_needed()
+    started = time.perf_counter()
+    migrate_all()
+    load_registered_emails()
+    maintenance.start()
+    event_log.start()
+    profiler.start(app.routes)
+    app.state.startup_time = time.perf_counter() - started
+    if app.state.startup_time > STARTUP_BUDGET:
+        logger.warning(
+            "startup took %.3fs (budget %.3fs)", app.state.startup_time, STARTUP_BUDGET
+        )
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    maintenance.stop()
+    event_log.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("migrate")
+    commands.add_parser("explain")
+    admin_parser = commands.add_parser("create-admin")
+    admin_parser.add_argument("--email", required=True)
+    admin_parser.add_argument("--user-name", default="admin")
+    serve_parser = commands.add_parser("serve")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--workers", type=int, default=os.cpu_count())
+    rebalance_parser = commands.add_parser("rebalance")
+    # the layout the todos are in now, not TODO_SHARDS, which usually already
+    # names the layout being moved to; 0 means the directory database
+    rebalance_parser.add_argument("--from-shards", type=int, default=0)
+    rebalance_parser.add_argument("--to-shards", type=int, required=True)
+    args = parser.parse_args()
+
+    migrate_all()
+    if args.command == "create-admin":
+        # kept off the command line so it stays out of shell history and ps
+        password = os.environ.get("ADMIN_PASSWORD") or getpass.getpass()
+        create_admin(args.email, password, args.user_name)
+    elif args.command == "explain":
+        sorted_in_memory = False
+        for case, plan in explain_task_queries(engine).items():
+            print(case, plan)
+            sorted_in_memory |= any("TEMP B-TREE" in step for step in plan)
+        if sorted_in_memory:
+            raise SystemExit("task list queries need a temp B-tree sort")
+    elif args.command == "serve":
+        # hand over to the uvicorn CLI so worker processes import main08 only
+        # once; migrations already ran above, so each worker just checks the version
+        os.execvp(
+            sys.executable,
+            [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "main08:app",
+                "--host",
+                args.host,
+                "--port",
+                str(args.port),
+                "--workers",
+                str(args.workers),
+            ],
+        )
+    elif args.command == "rebalance":
+        if args.from_shards == args.to_shards:
+            raise SystemExit("--from-shards and --to-shards are the same layout")
+        moved = rebalance(args.from_shards, args.to_shards)
+        print(f"moved {moved} todos into {args.to_shards} shard(s)")